@@ -1,33 +1,39 @@
-import csv
-import yahoofinancials as yf
+import gc
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+import yfinance as yf
+import numpy
 import pandas
-from statsmodels.formula.api import ols
 import matplotlib.pyplot as plt
 
 
-COLUMNS = {
-  "firm": 0,
-  "ticker": 1,
-  "start_date": 2,
-  "end_date": 3
-}
-
 SNP_TICKER = "SPY"
 US_BONDS_TICKER = "^IRX"
-UNUSED_COLUMNS = ['date','high','low','open','close','volume']
+CACHE_DIR = ".cache"
+CACHE_TTL_SECONDS = 24 * 60 * 60
+MAX_WORKERS = 8
+GC_INTERVAL = 100
 
-firms = []
-start_dates = []
-end_dates = []
-alphas = []
-betas = []
-sharpes = []
-treynors = []
-annuals = []
+def get_cache_path(ticker, start, end):
+  '''
+  Get the path of the cache file for specific stock between start and end dates
 
-def get_daily_price_data(ticker, start, end):
+  Parameters
+  ----------
+  ticker : Stock identifier
+  start : Start date of the time range
+  end : End date of the time range
+
+  Returns
+  -------
+  Path of the CSV cache file
+  '''
+  return os.path.join(CACHE_DIR, f"{ticker}_{start}_{end}.csv")
+
+def read_cached_price_data(ticker, start, end):
   '''
-  Get daily price data for specific stock between start and end dates
+  Read daily price data from the cache if it exists and is not older than CACHE_TTL_SECONDS
 
   Parameters
   ----------
@@ -37,174 +43,284 @@ def get_daily_price_data(ticker, start, end):
 
   Returns
   -------
-  The YahooFinancials historical price data of the stock in the given dates
+  The cached daily price data, or None if missing or expired
   '''
-  return yf.YahooFinancials(ticker).get_historical_price_data(
-    start_date=start,
-    end_date=end,
-    time_interval='daily'
-  )
+  path = get_cache_path(ticker, start, end)
+  try:
+    if time.time() - os.path.getmtime(path) > CACHE_TTL_SECONDS:
+      return None
+    return pandas.read_csv(path, index_col='date', parse_dates=['date'], float_precision='round_trip')
+  except (OSError, ValueError):
+    return None
+
+def write_cached_price_data(ticker, start, end, price_data):
+  '''
+  Write daily price data to the cache
+
+  Parameters
+  ----------
+  ticker : Stock identifier
+  start : Start date of the time range
+  end : End date of the time range
+  price_data : daily price data
+  '''
+  os.makedirs(CACHE_DIR, exist_ok=True)
+  # 17 significant digits so cached prices read back bit for bit
+  price_data.to_csv(get_cache_path(ticker, start, end), float_format='%.17g')
 
-def create_dataframe(price_data, ticker, price_column):
+def get_daily_price_data(ticker, start, end):
   '''
-  Creates pandas dataframe from given data, removes unused columns, formatting dates and renaming specific columns
+  Get daily price data for specific stock between start and end dates.
+  Results are persisted to CACHE_DIR, so later runs over the same date range
+  do not download the data again
 
   Parameters
   ----------
-  price_data : YahooFinancials historical price data
   ticker : Stock identifier
+  start : Start date of the time range
+  end : End date of the time range
+
+  Returns
+  -------
+  A pandas dataframe with the adjusted close prices of the stock in the given dates, indexed by date
+  '''
+  price_data = read_cached_price_data(ticker, start, end)
+  if price_data is None:
+    history = yf.Ticker(ticker).history(start=start, end=end, interval='1d', auto_adjust=True)
+    price_data = history.reindex(columns=['Close'])
+    # each exchange reports midnight in its own timezone, drop it so dates of
+    # different tickers align
+    price_data.index = pandas.DatetimeIndex(price_data.index).tz_localize(None).rename('date')
+    # only cache successful downloads
+    if not price_data.empty:
+      write_cached_price_data(ticker, start, end, price_data)
+  return price_data
+
+def fetch_all_price_data(firms):
+  '''
+  Download the daily price data of every firm, the market and the risk free rate concurrently.
+  Each (ticker, start, end) combination is downloaded only once
+
+  Parameters
+  ----------
+  firms : dataframe of firm, ticker, start date and end date
+
+  Returns
+  -------
+  A dict mapping (ticker, start, end) to its daily price data
+  '''
+  keys = set()
+  for firm_ticker, start, end in zip(firms['ticker'], firms['start'], firms['end']):
+    for ticker in (firm_ticker, SNP_TICKER, US_BONDS_TICKER):
+      keys.add((ticker, start, end))
+
+  # the pool size bounds the number of concurrent requests sent to Yahoo
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    futures = {key: executor.submit(get_daily_price_data, *key) for key in keys}
+    return {key: future.result() for key, future in futures.items()}
+
+def create_dataframe(price_data, price_column):
+  '''
+  Creates pandas dataframe from given data with only the adjusted close column indexed by date,
+  skipping days with missing prices and keeping only the last row of repeated dates
+
+  Parameters
+  ----------
+  price_data : daily price data
   price_column : Name for the price coloun of the stock
 
   Returns
   -------
   A pandas dataframe
   '''
-  df = pandas.DataFrame(price_data[ticker]['prices'])
-  df = df.dropna()
-  df = df.drop(UNUSED_COLUMNS, axis=1)
-  df["formatted_date"]=pandas.to_datetime(df["formatted_date"])
-  df = df.rename({"formatted_date":"date"},axis=1)
-  df = df.rename({"adjclose":price_column},axis=1)
-  return df
+  close = price_data['Close'].dropna()
+  # Yahoo occasionally reports the same date twice, which the date index alignment rejects
+  close = close[~close.index.duplicated(keep='last')]
+  return close.to_frame(price_column)
 
-def create_price_data_frame(price_data, ticker, price_column):
+def create_price_data_frame(price_data, price_column):
   '''
   Creates pandas dataframe by calling create_dataframe and adding a return column by calculating the percent change
 
   Parameters
   ----------
-  price_data : YahooFinancials historical price data
-  ticker : Stock identifier
+  price_data : daily price data
   price_column : Name for the price coloun of the stock
 
   Returns
   -------
   A pandas dataframe with a return column
   '''
-  df = create_dataframe(price_data, ticker, price_column)
-  df["r_{}".format(price_column)]=df[price_column].pct_change()
+  df = create_dataframe(price_data, price_column)
+  prices = df[price_column].to_numpy(dtype=float)
+  returns = numpy.empty_like(prices)
+  returns[:1] = numpy.nan
+  numpy.divide(prices[1:], prices[:-1], out=returns[1:])
+  returns[1:] -= 1
+  df['r_' + price_column]=returns
   return df
 
-def create_return_data_frame(price_data, ticker, price_column):
+def create_return_data_frame(price_data, price_column):
   '''
   Creates pandas dataframe by calling create_dataframe and adding a return column by changing the return from annual return to daily return
 
   Parameters
   ----------
-  price_data : YahooFinancials historical price data
-  ticker : Stock identifier
+  price_data : daily price data
   price_column : Name for the price coloun of the stock
 
   Returns
   -------
   A pandas dataframe with a return column
   '''
-  df = create_dataframe(price_data, ticker, price_column)
-  df[price_column]=df[price_column]/100
-  df["r_{}".format(price_column)]=((1+df[price_column]) ** (1/365)) - 1
+  df = create_dataframe(price_data, price_column)
+  rates = df[price_column].to_numpy(dtype=float) / 100
+  df[price_column]=rates
+  # (1 + r) ** (1/365) - 1, evaluated without precision loss for rates near zero
+  df['r_' + price_column]=numpy.expm1(numpy.log1p(rates) / 365)
   return df
 
-def calc_sharpe(price_data):
+def create_firm_data_frame(firm_price_data, snp_df, us_bonds_df):
   '''
-  Calculate sharpe_ratio for a specific firm
+  Creates the firm pandas dataframe and merges it with the market and risk free dataframes.
+  Intermediate dataframes are freed when the function returns
 
   Parameters
   ----------
-  price_data : YahooFinancials historical price data
+  firm_price_data : daily price data of the firm
+  snp_df : market dataframe of the same date range
+  us_bonds_df : risk free dataframe of the same date range
 
   Returns
   -------
-  sharpe ratio value
+  A pandas dataframe with the firm, market and risk free prices and returns
   '''
-  r_firm_avg = price_data['r_firm'].mean()
-  r_rf_avg = price_data['r_rf'].mean()
-  r_firm_std_dev = price_data['r_firm'].std()
-  return (r_firm_avg - r_rf_avg) / r_firm_std_dev
+  firm_df = create_price_data_frame(firm_price_data, 'firm')
+
+  # merge the dataframes into a single dataframe with the relevant columns
+  # all three dataframes are indexed by date, so aligning them is an index intersection
+  df = pandas.concat([firm_df, snp_df, us_bonds_df], axis=1, join='inner')
+  # prices are never missing, only the first return of each price series
+  df.dropna(subset=['r_firm','r_market','r_rf'], inplace=True)
+  return df
 
-def calc_treynor(price_data, beta):
+def calc_alphas_betas(x, y):
   '''
-  Calculate treynor_ratio for a specific firm
+  Calculate alpha and beta of the CAPM regression r_firm - r_rf ~ r_market - r_rf
+  for a group of firms sharing the same market excess returns, using a single least squares solve
 
   Parameters
   ----------
-  price_data : YahooFinancials historical price data
-  beta : beta value of the OLS regression
+  x : market excess returns, of shape (T,)
+  y : firm excess returns, of shape (T, N)
 
   Returns
   -------
-  treynor ratio value
+  arrays of alpha and beta values, of shape (N,)
   '''
-  r_firm_avg = price_data['r_firm'].mean()
-  r_rf_avg = price_data['r_rf'].mean()
-  return (r_firm_avg - r_rf_avg) / beta
+  design = numpy.column_stack([numpy.ones_like(x), x])
+  # row 0 holds the alphas and row 1 the betas, one column per firm
+  params = numpy.linalg.lstsq(design, y, rcond=None)[0]
+  return params[0], params[1]
 
-def calc_annual_return(df):
+def calc_sharpe_treynor(r_firm, r_rf, betas):
   '''
-  Calculate annual return for a specific firm
+  Calculate sharpe_ratio and treynor_ratio for a group of firms in a single pass over their returns
 
   Parameters
   ----------
-  df : YahooFinancials historical price data
+  r_firm : firm returns, of shape (T, N)
+  r_rf : risk free returns, of shape (T,)
+  betas : beta values of the OLS regression, of shape (N,)
 
   Returns
   -------
-  annual return value
+  arrays of sharpe ratio and treynor ratio values, of shape (N,)
   '''
-  first_value = df.iloc[0]['firm']
-  last_value = df.iloc[-1]['firm']
-  r_total = (last_value / first_value) - 1
+  r_firm_avg = r_firm.mean(axis=0)
+  r_rf_avg = r_rf.mean()
+  # sample standard deviation, as computed by pandas
+  r_firm_std_dev = r_firm.std(axis=0, ddof=1)
+  excess_return = r_firm_avg - r_rf_avg
+  return excess_return / r_firm_std_dev, excess_return / betas
+
+def calc_annual_returns(prices, num_of_days):
+  '''
+  Calculate annual return for a group of firms
 
-  first_date = df.iloc[0]['date']
-  last_date = df.iloc[-1]['date']
-  num_of_days = (last_date-first_date).days
+  Parameters
+  ----------
+  prices : firm prices, of shape (T, N)
+  num_of_days : number of days between the first and last price of each firm, of shape (N,)
 
-  return ((1 + r_total) ** (365 / num_of_days)) - 1
+  Returns
+  -------
+  array of annual return values, of shape (N,)
+  '''
+  first_values = prices[0]
+  last_values = prices[-1]
+  r_total = (last_values / first_values) - 1
+  return numpy.expm1(numpy.log1p(r_total) * 365 / num_of_days)
 
-def append_data(firm, start, end, alpha, beta, sharpe_ratio, treynor_ratio, annual_return):
+def calc_statistics(dfs):
   '''
-  appends output values to their designated arrays
+  Calculate alpha, beta, sharpe ratio, treynor ratio and annual return of every firm.
+  Firms sharing the same market and risk free returns (same dates and date range) are stacked
+  into (T, N) matrices, so each statistic is computed once per group instead of once per firm
 
   Parameters
   ----------
-  firm : firm name
-  start : start date
-  end : end date
-  alpha : alpha value of OLS regression
-  beta : beta value of OLS regression
-  sharpe_ratio : sharpe ratio
-  treynor_ratio : treynor ratio
-  annual_return : annual return
+  dfs : list of firm dataframes
+
+  Returns
+  -------
+  list of (alpha, beta, sharpe_ratio, treynor_ratio, annual_return) values, in the order of dfs
   '''
-  firms.append(firm)
-  start_dates.append(start)
-  end_dates.append(end)
-  alphas.append(alpha)
-  betas.append(beta)
-  sharpes.append(sharpe_ratio)
-  treynors.append(treynor_ratio)
-  annuals.append(annual_return)
-
-def create_figures(df, alpha, beta, firm_name):
+  groups = {}
+  for index, df in enumerate(dfs):
+    r_rf = df['r_rf'].to_numpy()
+    x = df['r_market'].to_numpy() - r_rf
+    group = groups.setdefault((x.tobytes(), r_rf.tobytes()), (x, r_rf, []))
+    group[2].append(index)
+
+  statistics = [None] * len(dfs)
+  for x, r_rf, indices in groups.values():
+    group_dfs = [dfs[index] for index in indices]
+    r_firm = numpy.column_stack([df['r_firm'].to_numpy() for df in group_dfs])
+    prices = numpy.column_stack([df['firm'].to_numpy() for df in group_dfs])
+    num_of_days = numpy.array([(df.index[-1] - df.index[0]).days for df in group_dfs])
+
+    alphas, betas = calc_alphas_betas(x, r_firm - r_rf[:, numpy.newaxis])
+    sharpes, treynors = calc_sharpe_treynor(r_firm, r_rf, betas)
+    annuals = calc_annual_returns(prices, num_of_days)
+    for column, index in enumerate(indices):
+      statistics[index] = (alphas[column], betas[column], sharpes[column], treynors[column], annuals[column])
+  return statistics
+
+def create_figures(fig, ax, df, alpha, beta, firm_name):
   '''
-  Create 4 figures for a specific firm
+  Create 4 figures for a specific firm, reusing the given figure and axes
 
   Parameters
   ----------
+  fig : matplotlib figure shared between firms
+  ax : 2x2 array of the figure axes
   df : firm dataframe
   alpha : alpha value
   beta : beta value
   firm_name : Name of firm
   '''
-  fig, ax=plt.subplots(2,2,figsize=(15,10))
+  for axis in ax.flat:
+    axis.clear()
 
-  ax[0,0].plot(df['date'], df['firm'])
+  ax[0,0].plot(df.index, df['firm'])
   ax[0,0].set_title(f"Stock Prices: {firm_name}")
   ax[0,0].set_ylabel("Price ($)")
   ax[0,0].grid(axis='y')
   ax[0,0].tick_params(axis='x', rotation=45)
   ax[0,0].tick_params(axis='both', labelsize=12)
 
-  ax[0,1].plot(df['date'], df['r_firm'])
+  ax[0,1].plot(df.index, df['r_firm'])
   ax[0,1].set_title(f"Stock returns: {firm_name}")
   ax[0,1].set_ylabel("Returns (%)")
   ax[0,1].tick_params(axis='x', rotation=45)
@@ -217,69 +333,75 @@ def create_figures(df, alpha, beta, firm_name):
   ax[1,0].set_xlabel('Returns')
   ax[1,0].set_ylabel('Frequency')
 
-  x_difference = df['r_market'] - df['r_rf']
-  y_difference = df['r_firm'] - df['r_rf']
-  ax[1,1].plot(x_difference, beta * x_difference + alpha, color='red', linestyle='--')
-  ax[1,1].scatter(x_difference, y_difference, marker='o', s = 5)
+  r_rf = df['r_rf'].to_numpy()
+  x_difference = df['r_market'].to_numpy() - r_rf
+  y_difference = df['r_firm'].to_numpy() - r_rf
+  ax[1,1].plot(x_difference, y_difference, marker='.', linestyle='none', markersize=5)
+  # the regression line is straight, its two endpoints are enough to draw it
+  x_line = numpy.array([x_difference.min(), x_difference.max()])
+  ax[1,1].plot(x_line, beta * x_line + alpha, color='red', linestyle='--')
   ax[1,1].grid(axis='y')
   ax[1,1].set_title(f"Returns Vs. market returns: {firm_name}")
   ax[1,1].set_ylabel("Adjusted returns")
   ax[1,1].set_xlabel("Adjusted market returns")
 
-  plt.tight_layout()
-  fig.savefig(f"{firm_name}_plot.jpg")
-
-
-with open('firms_dates.csv', 'r', newline='') as csvfile:
-  csv_reader = csv.reader(csvfile)
-  # skip first row (headers)
-  next(csv_reader)
-
-  for row in csv_reader:
-    # skip empty lines
-    if not row:
-      continue
-
-    firm_name = row[COLUMNS["firm"]]
-    ticker = row[COLUMNS["ticker"]]
-    start_date = row[COLUMNS["start_date"]]
-    end_date = row[COLUMNS["end_date"]]
-
-    firm_df = create_price_data_frame(get_daily_price_data(ticker, start_date, end_date), ticker, 'firm')
-    snp_df = create_price_data_frame(get_daily_price_data(SNP_TICKER, start_date, end_date), SNP_TICKER, 'market')
-    us_bonds_df = create_return_data_frame(get_daily_price_data(US_BONDS_TICKER, start_date, end_date), US_BONDS_TICKER, 'rf')
-
-    # merge the dataframes into a single dataframe with the relevant columns
-    df = pandas.merge(pandas.merge(firm_df, snp_df, on='date'), us_bonds_df, on='date')
-    df = df.dropna()
-    df = df[['date','firm','market','rf','r_firm','r_market', 'r_rf']]
-
-    # calculate requested columns
-    model = ols(formula='r_firm - r_rf ~ r_market - r_rf', data=df).fit()
-    alpha = model.params['Intercept']
-    beta = model.params['r_market']
-
-    sharpe_ratio = calc_sharpe(df)
-    treynor_ratio = calc_treynor(df, beta)
-    annual_return = calc_annual_return(df)
-
-    append_data(
-      row[COLUMNS["firm"]], row[COLUMNS["start_date"]], row[COLUMNS["end_date"]],
-      alpha, beta, sharpe_ratio, treynor_ratio, annual_return
-    )
-
-    create_figures(df, alpha, beta, firm_name)
-
-final_data = {
-  'firms': firms,
-  'start_dates': start_dates,
-  'end_dates': end_dates,
-  'alphas': alphas,
-  'betas': betas,
-  'sharpes': sharpes,
-  'treynors': treynors,
-  'annuals': annuals
-}
-
-final_df = pandas.DataFrame(final_data)
+  fig.savefig(f"{firm_name}_plot.png", dpi=80)
+
+
+# dates are kept as strings, as given in the CSV
+firms = pandas.read_csv('firms_dates.csv', dtype=str)
+rows = list(firms.itertuples(index=False))
+
+price_data = fetch_all_price_data(firms)
+
+# the market and risk free dataframes only depend on the date range, build them once per range
+market_dfs = {}
+for date_range in set(zip(firms['start'], firms['end'])):
+  market_dfs[date_range] = (
+    create_price_data_frame(price_data[(SNP_TICKER, *date_range)], 'market'),
+    create_return_data_frame(price_data[(US_BONDS_TICKER, *date_range)], 'rf')
+  )
+
+dfs = [
+  create_firm_data_frame(
+    price_data[(row.ticker, row.start, row.end)], *market_dfs[(row.start, row.end)]
+  )
+  for row in rows
+]
+
+# the raw downloads are no longer needed once the dataframes are built
+del price_data, market_dfs
+
+# calculate requested columns
+statistics = calc_statistics(dfs)
+
+results = []
+# constrained layout is applied when the figure is drawn, replacing a tight_layout pass per firm
+fig, ax=plt.subplots(2,2,figsize=(15,10),layout='constrained')
+for index, (row, (alpha, beta, sharpe_ratio, treynor_ratio, annual_return)) in enumerate(zip(rows, statistics)):
+  firm_name = row.firm
+  df = dfs[index]
+  # release the firm dataframe once its figures are saved
+  dfs[index] = None
+
+  results.append({
+    'firms': firm_name,
+    'start_dates': row.start,
+    'end_dates': row.end,
+    'alphas': alpha,
+    'betas': beta,
+    'sharpes': sharpe_ratio,
+    'treynors': treynor_ratio,
+    'annuals': annual_return
+  })
+
+  create_figures(fig, ax, df, alpha, beta, firm_name)
+  del df
+
+  # amortize the cost of collecting cycles left by pandas and matplotlib
+  if (index + 1) % GC_INTERVAL == 0:
+    gc.collect()
+plt.close(fig)
+
+final_df = pandas.DataFrame.from_records(results)
 final_df.to_csv("results.csv")